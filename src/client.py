@@ -1,13 +1,12 @@
 import argparse
+import asyncio
 import logging
-import threading
-import time
 from base64 import b64encode
 
-import requests
-from pydantic import parse_raw_as
-from requests.auth import HTTPBasicAuth
-from websocket import WebSocketApp
+import httpx
+import websockets
+from aioconsole import ainput
+from pydantic import TypeAdapter
 
 from models import (
     UserCredentials,
@@ -20,6 +19,10 @@ from models import (
 
 logging.basicConfig(format="%(message)s", level=logging.INFO)
 
+# TypeAdapter construction is expensive, reuse single instance per type
+chat_list_adapter = TypeAdapter(list[ChatInfo])
+history_adapter = TypeAdapter(list[MessageInHistory])
+
 
 class Api:
     def __init__(self, credentials: UserCredentials, host: str = "127.0.0.1:8000"):
@@ -27,92 +30,102 @@ class Api:
         self.host = host
         self.version = "v1"
         self.url = f"http://{self.host}/{self.version}"
-        self.s = requests.Session()
-        self.s.auth = HTTPBasicAuth(self.credentials.name, self.credentials.password)
+        # one client per process: keep-alive makes every call after the
+        # first a single round trip
+        self.s = httpx.AsyncClient(
+            base_url=self.url,
+            auth=(credentials.name, credentials.password),
+            headers={"Content-Type": "application/json"},
+        )
+        self._basic = "Basic " + b64encode(
+            f"{credentials.name}:{credentials.password}".encode()
+        ).decode()
+
+    async def close(self):
+        await self.s.aclose()
 
-    def register(self):
-        r = self.s.post(f"{self.url}/register", data=self.credentials.json())
-        if not r.ok:
+    async def register(self):
+        r = await self.s.post("/register", content=self.credentials.model_dump_json())
+        if not r.is_success:
             raise RuntimeError(f"unable to register user ({r.json()['detail']})")
 
-    def login(self) -> UserPublic:
-        r = self.s.get(f"{self.url}/login")
-        if not r.ok:
+    async def login(self) -> UserPublic:
+        r = await self.s.get("/login")
+        if not r.is_success:
             raise RuntimeError(f"unable to login ({r.json()['detail']})")
-        return UserPublic.parse_raw(r.content)
+        return UserPublic.model_validate_json(r.content)
 
-    def get_chats(self) -> list[ChatInfo]:
-        r = self.s.get(f"{self.url}/chats")
-        if r.ok:
-            return parse_raw_as(list[ChatInfo], r.content)
+    async def get_chats(self) -> list[ChatInfo]:
+        r = await self.s.get("/chats")
+        if r.is_success:
+            return chat_list_adapter.validate_json(r.content)
         else:
             raise RuntimeError(f"unable to retrieve chat list: ({r.json()['tail']})")
 
-    def create_chat(self, chat: ChatCreate) -> int:
-        r = self.s.post(f"{self.url}/chats", data=chat.json())
-        if r.ok:
+    async def create_chat(self, chat: ChatCreate) -> int:
+        r = await self.s.post("/chats", content=chat.model_dump_json())
+        if r.is_success:
             return int(r.content)
         else:
             raise RuntimeError(f"unable to create new chat: ({r.json()['tail']})")
 
-    def join_chat(self, chat_id: int) -> ChatInfo:
-        r = self.s.post(f"{self.url}/chats/{chat_id}/join")
-        if r.ok:
-            return ChatInfo.parse_raw(r.content)
+    async def join_chat(self, chat_id: int) -> ChatInfo:
+        r = await self.s.post(f"/chats/{chat_id}/join")
+        if r.is_success:
+            return ChatInfo.model_validate_json(r.content)
         else:
             raise RuntimeError(f"unable to create new chat: ({r.json()['tail']})")
 
-    def send_message(self, chat_id, msg: MessageCreate):
-        r = self.s.post(f"{self.url}/chats/{chat_id}/message", data=msg.json())
-        if not r.ok:
+    async def send_message(self, chat_id, msg: MessageCreate):
+        r = await self.s.post(
+            f"/chats/{chat_id}/message", content=msg.model_dump_json()
+        )
+        if not r.is_success:
             raise RuntimeError(f"unable to send message ({r.json()['detail']})")
 
-    def history(
-        self, chat_id: int, offset: int = 0, limit: int = 100
+    async def history(
+        self, chat_id: int, after_id: int = 0, limit: int = 100
     ) -> list[MessageInHistory]:
-        r = self.s.get(
-            f"{self.url}/chats/{chat_id}/history",
-            params={"offset": offset, "limit": limit},
+        r = await self.s.get(
+            f"/chats/{chat_id}/history",
+            params={"after_id": after_id, "limit": limit},
         )
-        if r.ok:
-            return parse_raw_as(list[MessageInHistory], r.content)
+        if r.is_success:
+            return history_adapter.validate_json(r.content)
         else:
             raise RuntimeError(
                 f"unable to retrieve chat history ({r.json()['detail']})"
             )
 
-    def listen_chat(self, chat_id, **kwargs) -> WebSocketApp:
-        credentials = b64encode(
-            f"{self.s.auth.username}:{self.s.auth.password}".encode()
-        ).decode()
-        auth = f"Basic {credentials}"
-        app = WebSocketApp(
+    def listen_chat(self, chat_id, **kwargs):
+        # permessage-deflate only adds CPU cost on sub-kilobyte chat frames
+        return websockets.connect(
             f"ws://{self.host}/{self.version}/chats/{chat_id}/listen",
             **kwargs,
-            header={"Authorization": auth},
+            extra_headers={"Authorization": self._basic},
+            compression=None,
         )
-        return app
 
 
 def delim():
     logging.info("~" * 40)
 
 
-def register_prompt(api: Api):
+async def register_prompt(api: Api):
     logging.info("Trying to register...")
     try:
-        api.register()
+        await api.register()
     except RuntimeError as err:
         logging.info(f"Error: {err}")
         return
     logging.info("Success!")
 
 
-def create_chat_prompt(api):
-    title = input("Chat title:\n > ")
+async def create_chat_prompt(api: Api):
+    title = await ainput("Chat title:\n > ")
     req = ChatCreate(title=title)
     try:
-        chat_id = api.create_chat(req)
+        chat_id = await api.create_chat(req)
         logging.info(f"Success! Created new chat with ID {chat_id}")
     except RuntimeError as err:
         logging.info(f"Error: {err}")
@@ -121,48 +134,52 @@ def create_chat_prompt(api):
 class ChatApp:
     chat: ChatInfo = None
     user_id: int = None
-    ws: WebSocketApp = None
 
     def __init__(self, api: Api):
         self.api = api
+
+    async def run(self):
         delim()
-        self.login()
+        await self.login()
         delim()
-        self.join_chat()
+        await self.join_chat()
         delim()
-        self.read_chat_history()
-        self.prepare_ws()
-        reading_thread = threading.Thread(target=self.receive_updates)
-        reading_thread.start()
-        time.sleep(0.5)
-        self.receive_user_input()
-
-    def login(self):
+        await self.read_chat_history()
+        logging.info("Connecting to server...")
+        async with self.api.listen_chat(self.chat.id) as ws:
+            logging.info("Connected!")
+            await asyncio.gather(
+                self.receive_updates(ws), self.receive_user_input(ws)
+            )
+
+    async def login(self):
         try:
             logging.info(f"Logging in as {self.api.credentials.name}...")
-            self.user_id = self.api.login().id
+            self.user_id = (await self.api.login()).id
         except RuntimeError as err:
             logging.info(f"Error: {err}")
             exit(1)
         logging.info("Success!")
 
-    def receive_user_input(self):
+    async def receive_user_input(self, ws):
         while True:
-            text = input(" > ")
-            self.ws.send(MessageCreate(text=text).json())
+            text = await ainput(" > ")
+            await ws.send(MessageCreate(text=text).model_dump_json())
 
-    def join_chat(self):
-        all_chats = self.api.get_chats()
+    async def join_chat(self):
+        all_chats = await self.api.get_chats()
         if not all_chats:
             logging.info(
                 'Error: no available chat rooms. Create one with command "create"'
             )
             exit(1)
 
+        chats_by_id = {chat.id: chat for chat in all_chats}
         open_chats = list()
         logging.info("Your chats:")
         for chat in all_chats:
-            if self.user_id in (m.id for m in chat.members):
+            member_ids = {m.id for m in chat.members}
+            if self.user_id in member_ids:
                 logging.info(
                     f"ID {chat.id}: {chat.title} ({len(chat.members)} member(s))"
                 )
@@ -173,39 +190,43 @@ class ChatApp:
             logging.info(f"ID {chat.id}: {chat.title} ({len(chat.members)} member(s))")
 
         while True:
-            chat_id = int(input("\nJoin chat with ID: "))
-            if chat_id not in [chat.id for chat in all_chats]:
+            chat_id = int(await ainput("\nJoin chat with ID: "))
+            if chat_id not in chats_by_id:
                 logging.info("Please enter correct chat ID")
             else:
                 break
 
-        self.chat = next(chat for chat in all_chats if chat.id == chat_id)
+        self.chat = chats_by_id[chat_id]
 
         if self.chat in open_chats:
             try:
-                self.api.join_chat(self.chat.id)
+                await self.api.join_chat(self.chat.id)
             except RuntimeError as err:
                 logging.info(f"Error: unable to join the chat ({err})")
                 exit(1)
 
-    def read_chat_history(self):
+    async def read_chat_history(self):
         logging.info("~~~ Chat history ~~~")
-        for message in self.api.history(self.chat.id):
+        for message in await self.api.history(self.chat.id):
             logging.info(f"[{message.timestamp}] {message.user.name}: {message.text}")
         logging.info("~~~ End of chat history ~~~")
 
-    def prepare_ws(self):
-        logging.info("Connecting to server...")
-        self.ws = self.api.listen_chat(self.chat.id)
-        self.ws.on_message = self.read_message
-        self.ws.on_open = lambda _: logging.info("Connected!")
+    async def receive_updates(self, ws):
+        async for data in ws:
+            message: MessageInHistory = MessageInHistory.model_validate_json(data)
+            logging.info(f"\r[{message.timestamp}] {message.user.name}: {message.text}")
 
-    def receive_updates(self):
-        self.ws.run_forever()
 
-    def read_message(self, wsapp, data):
-        message: MessageInHistory = MessageInHistory.parse_raw(data)
-        logging.info(f"\r[{message.timestamp}] {message.user.name}: {message.text}")
+async def run_command(command: str, api: Api):
+    try:
+        if command == "register":
+            await register_prompt(api)
+        elif command == "create":
+            await create_chat_prompt(api)
+        elif command == "join":
+            await ChatApp(api).run()
+    finally:
+        await api.close()
 
 
 def main():
@@ -239,13 +260,7 @@ def main():
 
     args = parser.parse_args()
     api = Api(UserCredentials(name=args.u, password=args.p), f"{args.host}:{args.port}")
-
-    if args.command == "register":
-        register_prompt(api)
-    elif args.command == "create":
-        create_chat_prompt(api)
-    elif args.command == "join":
-        ChatApp(api)
+    asyncio.run(run_command(args.command, api))
 
 
 if __name__ == "__main__":
@@ -1,75 +1,136 @@
+import os
+import socket
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import select, exc
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import select, exc, exists, bindparam
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from db import User, Chat, Session, Message
+from db import User, Chat, Session, Message, chat_members_table
 from models import UserCredentials, ChatCreate, MessageCreate
 
-import syslog
+import logging
+import logging.handlers
+import queue
 
-syslog.openlog("cli-chat")
+# message logging must stay off the write path: the writer only enqueues a
+# record in memory, a QueueListener thread does the actual syslog sends
+if os.path.exists("/dev/log"):
+    _syslog_handler = logging.handlers.SysLogHandler(
+        address="/dev/log", socktype=socket.SOCK_DGRAM
+    )
+else:
+    _syslog_handler = logging.NullHandler()
+
+_log_queue = queue.SimpleQueue()
+_syslog_listener = logging.handlers.QueueListener(_log_queue, _syslog_handler)
+_syslog_listener.start()
+
+message_log = logging.getLogger("cli-chat.messages")
+message_log.setLevel(logging.INFO)
+message_log.propagate = False
+message_log.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+HISTORY_LIMIT_MAX = 500
+
+# statements are built once and executed with bound parameters, keeping
+# per-call construction out of hot paths and letting SQLAlchemy reuse the
+# compiled SQL
+USER_BY_NAME = select(User).where(User.name == bindparam("name"))
+IS_CHAT_MEMBER = select(
+    exists().where(
+        chat_members_table.c.chat_id == bindparam("chat_id"),
+        chat_members_table.c.user_id == bindparam("user_id"),
+    )
+)
+CHAT_LIST = select(Chat).options(selectinload(Chat.members)).order_by(Chat.id)
+CHAT_HISTORY = (
+    select(Message)
+    .where(Message.chat_id == bindparam("chat_id"), Message.id > bindparam("after_id"))
+    .order_by(Message.id)
+    .limit(bindparam("limit"))
+    .options(selectinload(Message.user))
+)
 
 
-def get_user(ses: Session, user_id: int) -> Optional[User]:
-    return ses.get(User, user_id)
+async def get_user(ses: Session, user_id: int) -> Optional[User]:
+    return await ses.get(User, user_id)
 
 
-def get_user_by_name(ses: Session, name: str) -> Optional[User]:
-    q = select(User).where(User.name == name)
-    return ses.execute(q).scalar_one_or_none()
+async def get_user_by_name(ses: Session, name: str) -> Optional[User]:
+    return (await ses.execute(USER_BY_NAME, {"name": name})).scalar_one_or_none()
 
 
-def create_user(ses: Session, credentials: UserCredentials) -> Optional[int]:
+async def create_user(ses: Session, credentials: UserCredentials) -> Optional[int]:
     user = User(name=credentials.name, password=credentials.password)
     ses.add(user)
     try:
-        ses.commit()
+        await ses.commit()
         return user.id
     except exc.IntegrityError:
         return None
 
 
-def create_chat(
+async def create_chat(
     ses: Session, chat_info: ChatCreate, owner_user_id: int
 ) -> Optional[int]:
     chat = Chat(title=chat_info.title)
-    chat.members.append(ses.get(User, owner_user_id))
+    chat.members.append(await ses.get(User, owner_user_id))
+    ses.add(chat)
     try:
-        ses.commit()
+        await ses.commit()
         return chat.id
     except exc.IntegrityError as err:
         return None
 
 
-def get_chat(ses: Session, chat_id) -> Optional[User]:
-    return ses.get(Chat, chat_id)
+async def get_chat(ses: Session, chat_id) -> Optional[Chat]:
+    # members are eager-loaded: lazy loads are not available on AsyncSession
+    return await ses.get(Chat, chat_id, options=[selectinload(Chat.members)])
 
 
-def get_chat_list(ses: Session) -> list[Chat]:
-    q = select(Chat).options(subqueryload(Chat.members))
-    return ses.execute(q).scalars().all()
+async def is_chat_member(ses: Session, chat_id: int, user_id: int) -> bool:
+    # existence probe on the association table: covered by its composite
+    # primary key, no member rows are fetched
+    params = {"chat_id": chat_id, "user_id": user_id}
+    return (await ses.execute(IS_CHAT_MEMBER, params)).scalar()
 
 
-def get_chat_history(
-    ses: Session, chat_id: int, offset: int, limit: Optional[int] = None
-):
-    q = select(Message).where(Message.chat_id == chat_id, Message.id >= offset)
-    if limit:
-        q = q.limit(limit)
-    return ses.execute(q).scalars().all()
+async def get_chat_list(ses: Session) -> list[Chat]:
+    return (await ses.execute(CHAT_LIST)).scalars().all()
 
 
-def create_message(
-    ses: Session, msg: MessageCreate, user_id: int, chat_id: int
-) -> Message:
-    message = Message(
-        chat_id=chat_id, user_id=user_id, text=msg.text, timestamp=datetime.now()
-    )
-    ses.add(message)
-    ses.commit()
-    syslog.syslog(
-        syslog.LOG_INFO, f"C{message.chat_id}:U{message.user_id}:{message.text}"
-    )
-    return message
+async def get_chat_history(
+    ses: Session, chat_id: int, after_id: int = 0, limit: int = 100
+):
+    # keyset pagination: clients pass the highest message id they have
+    # seen, so every page is an index range seek bounded by the limit
+    params = {
+        "chat_id": chat_id,
+        "after_id": after_id,
+        "limit": min(limit, HISTORY_LIMIT_MAX),
+    }
+    return (await ses.execute(CHAT_HISTORY, params)).scalars().all()
+
+
+async def create_messages(
+    ses: Session, batch: list[tuple[MessageCreate, User, int]]
+) -> list[Message]:
+    messages = []
+    for msg, user, chat_id in batch:
+        message = Message(
+            chat_id=chat_id, user_id=user.id, text=msg.text, timestamp=datetime.now()
+        )
+        messages.append(message)
+    ses.add_all(messages)
+    await ses.commit()
+    # users belong to their request sessions; set the relationship after
+    # commit so they are not cascaded into this session
+    for message, (_, user, _) in zip(messages, batch):
+        set_committed_value(message, "user", user)
+    for message in messages:
+        message_log.info(
+            "C%s:U%s:%s", message.chat_id, message.user_id, message.text
+        )
+    return messages
@@ -1,19 +1,65 @@
 from pathlib import Path
 
-import sqlalchemy
-from sqlalchemy import Table, Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import (
+    Table,
+    Column,
+    ForeignKey,
+    Integer,
+    String,
+    DateTime,
+    Index,
+    event,
+)
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 DATABASE_FILE = Path(__file__).parent / "data.sqlite"
-DATABASE_URL = f"sqlite:///{DATABASE_FILE}"
-engine = sqlalchemy.create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
+DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_FILE}"
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
 )
 
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def make_engine(pool_size: int):
+    engine = create_async_engine(
+        DATABASE_URL,
+        connect_args={"timeout": 30},
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+        future=True,
+    )
+    event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+engine = make_engine(pool_size=16)
+# the message writer gets its own connection: requests hold their pooled
+# connections while they wait on the writer, so sharing one bounded pool
+# would deadlock as soon as a burst of posts exhausts it
+writer_engine = make_engine(pool_size=1)
+
 Base = declarative_base()
 
-Session = sessionmaker(bind=engine)
+Session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+WriterSession = sessionmaker(
+    bind=writer_engine, class_=AsyncSession, expire_on_commit=False
+)
 
 chat_members_table = Table(
     "chats_members",
@@ -45,6 +91,7 @@ class Chat(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (Index("ix_messages_chat_id_id", "chat_id", "id"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     chat_id = Column(Integer, ForeignKey("chats.id"))
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 
 class UserCredentials(BaseModel):
@@ -16,8 +16,7 @@ class UserPublic(BaseModel):
     id: int
     name: str
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ChatCreate(BaseModel):
@@ -31,8 +30,7 @@ class ChatDB(ChatCreate):
 class ChatInfo(ChatDB):
     members: list[UserPublic]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class MessageCreate(BaseModel):
@@ -43,5 +41,4 @@ class MessageInHistory(MessageCreate):
     timestamp: datetime
     user: UserPublic
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
@@ -1,10 +1,14 @@
 import asyncio
+import hashlib
+import logging
 import secrets
 import uuid
 from asyncio import Queue
 from collections import defaultdict
+from contextlib import suppress
 from typing import Optional
 
+import orjson
 from fastapi import (
     FastAPI,
     HTTPException,
@@ -15,11 +19,12 @@ from fastapi import (
     WebSocketDisconnect,
 )
 from fastapi import security
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBasicCredentials
 from starlette.requests import Request
 
 import crud
-from db import User, Chat, Base, Session, engine
+from db import User, Chat, Base, Session, WriterSession, engine, writer_engine
 from models import (
     UserCredentials,
     UserPublic,
@@ -29,23 +34,37 @@ from models import (
     MessageCreate,
 )
 
-Base.metadata.create_all(engine)
-
 
 class Broker:
     def __init__(self):
-        self.subscribers: [int, dict[uuid.UUID, Queue]] = defaultdict(dict)
+        # queues are kept in a flat list per chat so publish iterates a
+        # contiguous array; tokens are only needed to unsubscribe
+        self.subscribers: dict[int, list[Queue]] = defaultdict(list)
+        self.tokens: dict[int, dict[uuid.UUID, Queue]] = defaultdict(dict)
 
     def subscribe(self, chat_id: int, token: uuid.UUID) -> Queue:
-        self.subscribers[chat_id][token] = Queue()
-        return self.subscribers[chat_id][token]
+        queue = Queue()
+        self.subscribers[chat_id].append(queue)
+        self.tokens[chat_id][token] = queue
+        return queue
 
     def unsubscribe(self, chat_id: int, token: uuid.UUID):
-        self.subscribers[chat_id].pop(token)
-
-    async def publish(self, chat_id: int, message: MessageInHistory):
-        tasks = [sub.put(message) for sub in self.subscribers[chat_id].values()]
-        await asyncio.gather(*tasks)
+        queue = self.tokens[chat_id].pop(token)
+        self.subscribers[chat_id].remove(queue)
+        if not self.subscribers[chat_id]:
+            del self.subscribers[chat_id]
+            del self.tokens[chat_id]
+
+    def publish(self, chat_id: int, payload: bytes):
+        # payload is serialized once by the caller; queues are unbounded,
+        # so put_nowait never fails and there is no need to allocate a
+        # coroutine per subscriber. Plain .get avoids the defaultdict
+        # creating an entry for every chat ever published to
+        subscribers = self.subscribers.get(chat_id)
+        if not subscribers:
+            return
+        for queue in subscribers:
+            queue.put_nowait(payload)
 
 
 class HTTPBasicWs(security.HTTPBasic):
@@ -58,35 +77,113 @@ class HTTPBasicWs(security.HTTPBasic):
             return await super().__call__(ws)
 
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 broker = Broker()
 auth_scheme = HTTPBasicWs()
 
+# message writes are funneled through a single task which batches them
+# into one commit, so a burst of posts pays for one fsync instead of N
+WRITE_BATCH_SIZE = 64
+write_queue: asyncio.Queue = asyncio.Queue()
+
+
+async def message_writer():
+    while True:
+        batch = [await write_queue.get()]
+        while not write_queue.empty() and len(batch) < WRITE_BATCH_SIZE:
+            batch.append(write_queue.get_nowait())
+        try:
+            async with WriterSession() as ses:
+                messages = await crud.create_messages(
+                    ses, [(msg, user, chat_id) for msg, user, chat_id, _ in batch]
+                )
+        except Exception as err:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            continue
+        for (_, user, chat_id, future), message in zip(batch, messages):
+            payload = orjson.dumps(
+                {
+                    "text": message.text,
+                    "timestamp": message.timestamp,
+                    "user": {"id": user.id, "name": user.name},
+                }
+            )
+            broker.publish(chat_id, payload)
+            # the request may have been cancelled while it waited
+            if not future.done():
+                future.set_result(message)
+
+
+def writer_task_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error("message writer task died", exc_info=task.exception())
+
+
+@app.on_event("startup")
+async def startup():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    app.state.writer_task = asyncio.create_task(message_writer())
+    app.state.writer_task.add_done_callback(writer_task_done)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.writer_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await app.state.writer_task
+    await engine.dispose()
+    await writer_engine.dispose()
+
 
 async def get_session() -> Session:
-    session = Session()
-    try:
+    async with Session() as session:
         yield session
-    finally:
-        session.close()
 
 
-async def get_current_user(
-    credentials: security.HTTPBasicCredentials = Depends(auth_scheme),
-    ses: Session = Depends(get_session),
-) -> User:
-    user = crud.get_user_by_name(ses, credentials.username)
+# Maps (username, password digest) to user id so repeated requests skip the
+# SELECT by name. Only successful logins are cached, so entries never go stale:
+# users cannot be renamed or change passwords.
+AUTH_CACHE_SIZE = 4096
+auth_cache: dict[tuple[str, bytes], int] = {}
+
+
+def password_digest(password: str) -> bytes:
+    return hashlib.blake2b(password.encode(), digest_size=16).digest()
+
+
+async def authenticate(ses: Session, credentials: HTTPBasicCredentials) -> User:
+    cache_key = (credentials.username, password_digest(credentials.password))
+    user_id = auth_cache.get(cache_key)
+    if user_id is not None:
+        return await crud.get_user(ses, user_id)
+
+    user = await crud.get_user_by_name(ses, credentials.username)
     if not user or not secrets.compare_digest(credentials.password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="incorrect username or password",
             headers={"WWW-Authenticate": "Basic"},
         )
+    if len(auth_cache) >= AUTH_CACHE_SIZE:
+        auth_cache.clear()
+    auth_cache[cache_key] = user.id
     return user
 
 
+async def get_current_user(
+    credentials: security.HTTPBasicCredentials = Depends(auth_scheme),
+    ses: Session = Depends(get_session),
+) -> User:
+    return await authenticate(ses, credentials)
+
+
 async def get_current_chat(chat_id: int, ses: Session = Depends(get_session)) -> Chat:
-    chat = crud.get_chat(ses, chat_id)
+    chat = await crud.get_chat(ses, chat_id)
     if not chat:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -96,44 +193,58 @@ async def get_current_chat(chat_id: int, ses: Session = Depends(get_session)) ->
 
 
 async def filter_chat_members(
-    user: User = Depends(get_current_user), chat=Depends(get_current_chat)
+    chat_id: int,
+    user: User = Depends(get_current_user),
+    ses: Session = Depends(get_session),
 ):
-    if user not in chat.members:
+    # checked against the association table directly so the chat and its
+    # member list are never loaded on the message/history path
+    if not await crud.is_chat_member(ses, chat_id, user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="you are not a member of this chat",
         )
 
 
-async def get_chat_stream(chat: Chat = Depends(get_current_chat)):
+async def get_chat_stream(chat_id: int):
     token = uuid.uuid4()
     try:
-        yield broker.subscribe(chat.id, token)
+        yield broker.subscribe(chat_id, token)
     finally:
-        broker.unsubscribe(chat.id, token)
+        broker.unsubscribe(chat_id, token)
 
 
 @app.post("/v1/register", status_code=201)
 async def create_user(
     credentials: UserCredentials, ses: Session = Depends(get_session)
 ):
-    user_id = crud.create_user(ses, credentials)
+    user_id = await crud.create_user(ses, credentials)
     if not user_id:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="this username is already taken",
         )
+    auth_cache.clear()
     return user_id
 
 
 @app.get("/v1/login", response_model=UserPublic)
 async def try_login(user: User = Depends(get_current_user)):
-    return UserPublic.from_orm(user)
+    return user
 
 
-@app.get("/v1/chats", response_model=list[ChatInfo])
+@app.get("/v1/chats")
 async def get_chats(ses: Session = Depends(get_session)):
-    return crud.get_chat_list(ses)
+    # build the ChatInfo payload by hand: response_model validation over
+    # every chat and member is the dominant cost of this endpoint
+    return [
+        {
+            "id": chat.id,
+            "title": chat.title,
+            "members": [{"id": m.id, "name": m.name} for m in chat.members],
+        }
+        for chat in await crud.get_chat_list(ses)
+    ]
 
 
 @app.post("/v1/chats", response_model=int)
@@ -142,7 +253,7 @@ async def create_chat(
     user: User = Depends(get_current_user),
     ses: Session = Depends(get_session),
 ):
-    return crud.create_chat(ses, chat, user.id)
+    return await crud.create_chat(ses, chat, user.id)
 
 
 @app.get("/v1/chats/{chat_id}", response_model=ChatInfo)
@@ -158,7 +269,7 @@ async def add_user_to_chat(
 ):
     if user not in chat.members:
         chat.members.append(user)
-    ses.commit()
+    await ses.commit()
     return chat
 
 
@@ -168,12 +279,12 @@ async def add_user_to_chat(
     response_model=list[MessageInHistory],
 )
 async def get_chat_history(
-    offset: int = Query(..., ge=0),
-    limit: int = Query(..., ge=0),
-    chat: Chat = Depends(get_current_chat),
+    chat_id: int,
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(100, ge=0, le=crud.HISTORY_LIMIT_MAX),
     ses: Session = Depends(get_session),
 ):
-    return crud.get_chat_history(ses, chat.id, offset, limit)
+    return await crud.get_chat_history(ses, chat_id, after_id, limit)
 
 
 @app.post(
@@ -183,25 +294,31 @@ async def get_chat_history(
 )
 async def post_message_to_chat(
     message: MessageCreate,
+    chat_id: int,
     user: User = Depends(get_current_user),
-    chat: Chat = Depends(get_current_chat),
-    ses: Session = Depends(get_session),
 ):
-    msg = crud.create_message(ses, message, user.id, chat.id)
-    msg = MessageInHistory.from_orm(msg)
-    await broker.publish(chat.id, msg)
-    return msg
+    future = asyncio.get_running_loop().create_future()
+    write_queue.put_nowait((message, user, chat_id, future))
+    return await future
 
 
 @app.websocket("/v1/chats/{chat_id}/listen")
 async def ws_listen_to_chat(
     ws: WebSocket,
-    user: User = Depends(get_current_user),
-    chat: Chat = Depends(get_current_chat),
-    ses: Session = Depends(get_session),
+    chat_id: int,
+    credentials: security.HTTPBasicCredentials = Depends(auth_scheme),
     stream: Queue = Depends(get_chat_stream),
-    _=Depends(filter_chat_members),
 ):
+    # a websocket lives for the whole chat session and must not pin a
+    # pooled connection that long, so auth and the membership check run
+    # in a session that is closed before the pump loop starts
+    async with Session() as ses:
+        user = await authenticate(ses, credentials)
+        if not await crud.is_chat_member(ses, chat_id, user.id):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="you are not a member of this chat",
+            )
     await ws.accept()
     closing = False  # TODO: sync primitive must be used instead
 
@@ -213,8 +330,8 @@ async def ws_listen_to_chat(
             except WebSocketDisconnect:
                 closing = True
                 return
-            msg = MessageCreate.parse_raw(data)
-            await post_message_to_chat(msg, user, chat, ses)
+            msg = MessageCreate.model_validate_json(data)
+            await post_message_to_chat(msg, chat_id, user)
 
     async def send_messages(ws: WebSocket):
         nonlocal closing
@@ -222,8 +339,8 @@ async def ws_listen_to_chat(
             if closing:
                 return
             try:
-                msg: MessageInHistory = await asyncio.wait_for(stream.get(), 3)
-                await ws.send_text(msg.json())
+                payload: bytes = await asyncio.wait_for(stream.get(), 3)
+                await ws.send_bytes(payload)
             except asyncio.exceptions.TimeoutError:
                 continue
 